@@ -1,139 +1,163 @@
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw
+import operator
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-def extract_avatars_from_grid(image_path, output_folder='avatars'):
+# 1-D kernel of the 9x9, sigma=2 Gaussian used before HoughCircles
+_GAUSSIAN_9 = cv2.getGaussianKernel(9, 2)
+
+# Fast deflate for avatar PNGs; files are slightly larger than at the default level
+PNG_COMPRESSION = 1
+
+@lru_cache(maxsize=None)
+def _circle_mask(r):
+    """
+    Filled circle of radius r drawn at the origin of a small (2r x 2r) mask.
+    Cached so each radius is rasterized only once.
+    """
+    mask = np.zeros((r * 2, r * 2), dtype=np.uint8)
+    cv2.circle(mask, (r, r), r, 255, -1)
+    mask.flags.writeable = False
+    return mask
+
+def _render_and_save(idx, cropped, x, y, r, x_min, y_min, output_folder):
+    """
+    Render a single circular avatar from its crop and save it as a PNG.
+    Runs in a worker thread; OpenCV releases the GIL while encoding.
+    The crop is modified in place when it already covers the whole avatar.
+    
+    Returns:
+        Path of the saved avatar
+    """
+    circ = _circle_mask(r)
+    
+    # Calculate paste position to center the cropped image
+    paste_x = r - (x - x_min)
+    paste_y = r - (y - y_min)
+    h, w = cropped.shape[:2]
+    
+    if (h, w) == (r * 2, r * 2) and cropped.shape[2] == 4:
+        # The crop is the whole avatar: write the circle straight into its alpha
+        output_img = cropped
+    else:
+        # Edge circle or no alpha: place the crop on a transparent canvas
+        output_img = np.zeros((r * 2, r * 2, 4), dtype=np.uint8)
+        region = output_img[paste_y:paste_y + h, paste_x:paste_x + w]
+        if cropped.shape[2] == 4:
+            region[...] = cropped
+        else:
+            # No alpha channel in the source: the crop is fully opaque
+            region[..., :3] = cropped
+            region[..., 3] = 255
+    
+    # Cut the circle out of the alpha channel
+    np.minimum(output_img[..., 3], circ, out=output_img[..., 3])
+    
+    # Save the individual avatar
+    output_path = os.path.join(output_folder, f'avatar_{idx}.png')
+    ok, buf = cv2.imencode('.png', output_img, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+    if not ok:
+        raise ValueError(f"Could not encode avatar_{idx}.png")
+    Path(output_path).write_bytes(buf.tobytes())
+    return output_path
+
+def extract_avatars_from_grid(image_path, output_folder='avatars', rows=None, cols=None):
     """
     Extract individual circular avatars from a grid image.
     
     Args:
         image_path: Path to the input PNG image
         output_folder: Folder where individual avatars will be saved
+        rows: Number of rows in the grid, if known (requires cols)
+        cols: Number of columns in the grid, if known (requires rows)
+    
+    When both rows and cols are given the avatar positions are computed
+    from the grid layout and circle detection is skipped entirely.
     """
     
+    # A grid layout needs both dimensions, each a positive integer
+    if (rows is None) != (cols is None):
+        raise ValueError("rows and cols must be given together")
+    if rows is not None:
+        rows = _positive_int('rows', rows)
+        cols = _positive_int('cols', cols)
+    
     # Create output directory if it doesn't exist
     Path(output_folder).mkdir(parents=True, exist_ok=True)
     
     # Load the image
-    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    img = None
+    if os.path.isfile(image_path):
+        data = np.fromfile(image_path, dtype=np.uint8)
+        if data.size:
+            img = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
     if img is None:
         raise ValueError(f"Could not load image from {image_path}")
     
-    # If image has alpha channel, use it; otherwise create one
-    if img.shape[2] == 3:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-    
-    # Convert to RGB for circle detection
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
-    
-    # Convert to grayscale for circle detection
-    gray = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2GRAY)
-    
-    # Apply Gaussian blur to reduce noise
-    blurred = cv2.GaussianBlur(gray, (9, 9), 2)
-    
-    # Detect circles using Hough Circle Transform
-    circles = cv2.HoughCircles(
-        blurred,
-        cv2.HOUGH_GRADIENT,
-        dp=1,
-        minDist=80,  # Minimum distance between circle centers
-        param1=50,   # Higher threshold for Canny edge detector
-        param2=30,   # Accumulator threshold for circle centers
-        minRadius=40,  # Minimum circle radius
-        maxRadius=70   # Maximum circle radius
-    )
-    
-    if circles is None:
-        print("No circles detected. Trying alternative method...")
-        circles = detect_circles_alternative(gray)
-    
-    if circles is not None:
-        # Round the circle parameters and convert to integers
-        circles = np.uint16(np.around(circles))
-        
-        # Sort circles by position (top to bottom, left to right)
-        circle_list = []
-        for circle in circles[0, :]:
-            circle_list.append(circle)
-        
-        # Sort by row first (y-coordinate), then by column (x-coordinate)
-        circle_list.sort(key=lambda c: (c[1], c[0]))
+    if rows is not None and cols is not None:
+        # Known layout: one avatar centered in each grid cell
+        circles = detect_circles_grid(img.shape, rows, cols)
+    else:
+        # Convert to grayscale for circle detection in a single pass
+        if img.shape[2] == 4:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         
-        # Group circles into rows based on y-coordinate proximity
-        rows = []
-        current_row = []
-        row_y = None
-        y_threshold = 30  # Maximum y-difference to be considered same row
+        # Detect on a half-resolution copy; circles only need coarse centers
+        small = cv2.resize(gray, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
         
-        for circle in circle_list:
-            if row_y is None or abs(circle[1] - row_y) < y_threshold:
-                current_row.append(circle)
-                if row_y is None:
-                    row_y = circle[1]
-            else:
-                # Sort current row by x-coordinate
-                current_row.sort(key=lambda c: c[0])
-                rows.append(current_row)
-                current_row = [circle]
-                row_y = circle[1]
+        # Blur + Hough band by band so each slice stays in cache
+        circles = _detect_circles_banded(small)
         
-        # Don't forget the last row
-        if current_row:
-            current_row.sort(key=lambda c: c[0])
-            rows.append(current_row)
+        if circles is not None:
+            # Scale back up to full-resolution coordinates; half-res pixel i
+            # covers full-res pixels 2i and 2i+1, so centers shift by 0.5
+            circles[..., :2] = circles[..., :2] * 2 + 0.5
+            circles[..., 2] *= 2
+        else:
+            print("No circles detected. Trying alternative method...")
+            circles = detect_circles_alternative(gray)
+    
+    if circles is not None:
+        # Round the circle parameters and convert to integers
+        circles = np.around(circles[0]).astype(np.int32)
         
-        # Flatten the sorted circles back into a single list
-        sorted_circles = []
-        for row in rows:
-            sorted_circles.extend(row)
+        # Grid layouts are already in row-major order; detected circles are not
+        if rows is None:
+            # Sort by row first (y-coordinate), then by column (x-coordinate).
+            # A new row starts wherever consecutive y values jump by the threshold.
+            y_threshold = 30  # Minimum y-gap between neighbours that starts a new row
+            circles = circles[np.argsort(circles[:, 1], kind='stable')]
+            row_ids = np.concatenate(([0], np.cumsum(np.diff(circles[:, 1]) >= y_threshold)))
+            circles = circles[np.lexsort((circles[:, 0], row_ids))]
+        sorted_circles = circles.tolist()
         
         print(f"Detected {len(sorted_circles)} avatars")
         
-        # Extract each avatar
+        # Crop each avatar here; encoding and saving run on worker threads
+        height, width = img.shape[:2]
+        tasks = []
         for idx, (x, y, r) in enumerate(sorted_circles, 1):
-            # Create a mask for the circular region
-            mask = np.zeros((img.shape[0], img.shape[1]), dtype=np.uint8)
-            cv2.circle(mask, (x, y), r, 255, -1)
-            
             # Calculate bounding box for the circle
             x_min = max(0, x - r)
-            x_max = min(img.shape[1], x + r)
+            x_max = min(width, x + r)
             y_min = max(0, y - r)
-            y_max = min(img.shape[0], y + r)
+            y_max = min(height, y + r)
             
-            # Crop the region
+            # Crop the region (a copy, since the worker may write into it)
             cropped = img[y_min:y_max, x_min:x_max].copy()
-            mask_cropped = mask[y_min:y_max, x_min:x_max]
-            
-            # Convert to PIL Image
-            pil_img = Image.fromarray(cv2.cvtColor(cropped, cv2.COLOR_BGRA2RGBA))
-            
-            # Create a new image with transparent background
-            output_size = (r * 2, r * 2)
-            output_img = Image.new('RGBA', output_size, (0, 0, 0, 0))
-            
-            # Create circular mask for the output
-            mask_output = Image.new('L', output_size, 0)
-            mask_draw = ImageDraw.Draw(mask_output)
-            mask_draw.ellipse([0, 0, output_size[0]-1, output_size[1]-1], fill=255)
-            
-            # Calculate paste position to center the cropped image
-            paste_x = r - (x - x_min)
-            paste_y = r - (y - y_min)
-            
-            # Paste the cropped image onto the output
-            output_img.paste(pil_img, (paste_x, paste_y))
-            
-            # Apply the circular mask
-            output_img.putalpha(mask_output)
             
-            # Save the individual avatar
-            output_path = os.path.join(output_folder, f'avatar_{idx}.png')
-            output_img.save(output_path, 'PNG')
-            print(f"Saved avatar_{idx}.png")
+            tasks.append((idx, cropped, x, y, r, x_min, y_min, output_folder))
+        
+        # Encoding and writing release the GIL, so threads overlap both
+        # without pickling every crop to a worker process
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for output_path in executor.map(_render_and_save, *zip(*tasks)):
+                print(f"Saved {os.path.basename(output_path)}")
     
     else:
         print("No circles could be detected in the image")
@@ -142,36 +166,159 @@ def extract_avatars_from_grid(image_path, output_folder='avatars'):
     print(f"\nExtraction complete! {len(sorted_circles)} avatars saved to '{output_folder}/' folder")
     return True
 
+def _detect_circles_banded(gray, band_height=256):
+    """
+    Run blur + HoughCircles over horizontal bands of a half-resolution
+    grayscale image. Bands are padded by the maximum radius so circles on
+    a boundary keep their context; each circle is kept by the band that
+    owns its center, and near-duplicates across a boundary are dropped.
+    
+    Returns:
+        (1, N, 3) float32 array of (x, y, radius), or None
+    """
+    min_dist = 40    # Minimum distance between circle centers (2 * minRadius)
+    max_radius = 35  # Maximum circle radius (70 px at full resolution)
+    overlap = max_radius
+    height = gray.shape[0]
+    
+    found = []
+    previous = np.empty((0, 3), dtype=np.float32)
+    for top in range(0, height, band_height):
+        bottom = min(height, top + band_height)
+        lo = max(0, top - overlap)
+        hi = min(height, bottom + overlap)
+        
+        # Apply Gaussian blur to reduce noise; 9x9 run as two 1-D passes
+        blurred = cv2.sepFilter2D(gray[lo:hi], -1, _GAUSSIAN_9, _GAUSSIAN_9)
+        
+        # Detect circles using Hough Circle Transform
+        circles = cv2.HoughCircles(
+            blurred,
+            cv2.HOUGH_GRADIENT,
+            dp=1,          # Accumulator at half resolution of the full image
+            minDist=min_dist,
+            param1=50,     # Higher threshold for Canny edge detector
+            param2=30,     # Accumulator threshold for circle centers
+            minRadius=20,  # Minimum circle radius (40 px at full resolution)
+            maxRadius=max_radius
+        )
+        if circles is None:
+            previous = previous[:0]
+            continue
+        
+        # Back to image coordinates; keep circles centered in this band
+        circles = circles[0]
+        circles[:, 1] += lo
+        circles = circles[(circles[:, 1] >= top) & (circles[:, 1] < bottom)]
+        
+        # Drop circles already found just across the boundary; only the
+        # previous band's centers within min_dist of it can collide
+        d = circles[:, np.newaxis, :2] - previous[np.newaxis, :, :2]
+        circles = circles[~((d ** 2).sum(axis=2) < min_dist ** 2).any(axis=1)]
+        
+        found.append(circles)
+        previous = circles[circles[:, 1] >= bottom - min_dist]
+    
+    if found:
+        circles = np.concatenate(found)
+        if len(circles):
+            return circles[np.newaxis]
+    return None
+
+def _positive_int(name, value):
+    """
+    Return value as an int, raising ValueError unless it is a positive
+    integer (NumPy integers included, bools excluded).
+    """
+    try:
+        if isinstance(value, bool):
+            raise TypeError
+        value = operator.index(value)
+    except TypeError:
+        raise ValueError(f"{name} must be a positive integer, got {value!r}") from None
+    if value < 1:
+        raise ValueError(f"{name} must be a positive integer, got {value!r}")
+    return value
+
+def detect_circles_grid(shape, rows, cols):
+    """
+    Compute avatar circles for a regular grid of known size.
+    Each avatar is assumed to be centered in its cell.
+    """
+    height, width = shape[:2]
+    cell_w = width / cols
+    cell_h = height / rows
+    if min(cell_w, cell_h) < 2:
+        raise ValueError(
+            f"A {rows}x{cols} grid leaves cells under 2 px in a {width}x{height} image"
+        )
+    r = min(cell_w, cell_h) // 2
+    
+    circles = [
+        [(col + 0.5) * cell_w, (row + 0.5) * cell_h, r]
+        for row in range(rows)
+        for col in range(cols)
+    ]
+    return np.array([circles], dtype=np.float32)
+
 def detect_circles_alternative(gray):
     """
     Alternative method to detect circles if HoughCircles fails.
-    Uses contour detection to find circular shapes.
+    Uses connected components to find circular shapes.
     """
     # Apply threshold
     _, thresh = cv2.threshold(gray, 240, 255, cv2.THRESH_BINARY_INV)
     
-    # Find contours
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Fill holes (e.g. white faces or shirts) so blob areas cover the whole
+    # outline: flood the background from a padded corner, then add back
+    # every pixel the flood could not reach
+    padded = cv2.copyMakeBorder(thresh, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    background = padded.copy()
+    cv2.floodFill(background, None, (0, 0), 255)
+    filled = (padded | cv2.bitwise_not(background))[1:-1, 1:-1]
     
-    circles = []
-    for contour in contours:
-        # Calculate area and perimeter
-        area = cv2.contourArea(contour)
-        if area < 1000:  # Skip small contours
-            continue
-        
-        # Fit a circle to the contour
-        (x, y), radius = cv2.minEnclosingCircle(contour)
-        
-        # Check if the contour is circular enough
-        circularity = 4 * np.pi * area / (cv2.arcLength(contour, True) ** 2)
-        if circularity > 0.7 and 40 < radius < 70:
-            circles.append([x, y, radius])
+    # Label connected blobs; stats rows are (left, top, width, height, area)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(filled)
+    
+    # Row 0 is the background
+    circles = _filter_circles(stats[1:])
     
-    if circles:
-        return np.array([circles], dtype=np.float32)
+    if len(circles):
+        return circles[np.newaxis]
     return None
 
+def _filter_circles(stats):
+    """
+    Keep the blobs from connectedComponentsWithStats that look like avatars.
+    A filled disk fills ~pi/4 of a square bounding box, which stands in for
+    the contour circularity check.
+    
+    Returns:
+        (M, 3) float32 array of (x, y, radius)
+    """
+    left = stats[:, 0].astype(np.float32)
+    top = stats[:, 1].astype(np.float32)
+    width = stats[:, 2].astype(np.float32)
+    height = stats[:, 3].astype(np.float32)
+    area = stats[:, 4].astype(np.float32)
+    
+    radius = np.maximum(width, height) / 2
+    aspect = np.minimum(width, height) / np.maximum(width, height)
+    extent = area / (width * height)
+    
+    keep = (
+        (area > 1000)
+        & (radius > 40) & (radius < 70)
+        & (aspect > 0.8)
+        & (extent > 0.6) & (extent < 0.85)
+    )
+    
+    circles = np.empty((keep.sum(), 3), dtype=np.float32)
+    circles[:, 0] = (left + width / 2)[keep]
+    circles[:, 1] = (top + height / 2)[keep]
+    circles[:, 2] = radius[keep]
+    return circles
+
 def main():
     """
     Main function to run the avatar extraction.